@@ -2,6 +2,7 @@ import asyncio
 import json
 import os
 import re
+import time
 from aiosteampy.client import SteamClient
 from yarl import URL
 import aiohttp
@@ -22,6 +23,16 @@ URLS_FILE = "urls.txt"
 SESSIONS_PATH = "./sessions"
 os.makedirs(SESSIONS_PATH, exist_ok=True)
 
+# Таймауты ожидания в браузере (мс). Можно переопределить в .env.
+UI_TIMEOUT_MS = int(os.getenv("UI_TIMEOUT_MS", "5000"))
+UI_TIMEOUT_MIN_MS = int(os.getenv("UI_TIMEOUT_MIN_MS", "1000"))
+NETWORK_TIMEOUT_MS = int(os.getenv("NETWORK_TIMEOUT_MS", "15000"))
+UI_SETTLE_TIMEOUT_MS = int(os.getenv("UI_SETTLE_TIMEOUT_MS", "500"))
+POINTS_SHOP_UI_TIMEOUT_MS = int(os.getenv("POINTS_SHOP_UI_TIMEOUT_MS", "10000"))
+UI_LATENCY_SAMPLES = 20
+
+_ui_latencies_ms: list[float] = []
+
 def save_session_cookies(username: str, cookies_dict: dict):
     """Сохраняет куки аккаунта в файл."""
     path = os.path.join(SESSIONS_PATH, f"{username}.json")
@@ -157,6 +168,53 @@ async def _check_if_game_owned(page: Page, steamid: str):
     return False
 
 
+def _ui_timeout() -> int:
+    """
+    Адаптивный таймаут ожидания элементов: втрое больше самой медленной из недавних реакций страницы,
+    в пределах UI_TIMEOUT_MIN_MS..UI_TIMEOUT_MS.
+    """
+    if not _ui_latencies_ms:
+        return UI_TIMEOUT_MS
+    return int(min(UI_TIMEOUT_MS, max(UI_TIMEOUT_MIN_MS, max(_ui_latencies_ms) * 3)))
+
+def _record_ui_latency(latency_ms: float):
+    """Запоминает время реакции страницы для расчета адаптивного таймаута."""
+    _ui_latencies_ms.append(latency_ms)
+    del _ui_latencies_ms[:-UI_LATENCY_SAMPLES]
+
+async def _wait_for_ui(target, selector: str, state: str = "visible", timeout: int | None = None):
+    """
+    Ожидание состояния элемента с адаптивным таймаутом.
+    Таймаут тоже учитывается как время реакции страницы, чтобы следующие ожидания стали длиннее.
+    """
+    timeout = timeout or _ui_timeout()
+    started = time.monotonic()
+    try:
+        element = await target.wait_for_selector(selector, state=state, timeout=timeout)
+    except PlaywrightTimeoutError:
+        _record_ui_latency(timeout)
+        raise
+    _record_ui_latency((time.monotonic() - started) * 1000)
+    return element
+
+async def _wait_for_modal_closed(page: Page, selector: str, steamid: str) -> bool:
+    """Ожидает исчезновения модального окна вместо фиксированной паузы."""
+    timeout = _ui_timeout()
+    try:
+        await _wait_for_ui(page, selector, state="hidden", timeout=timeout)
+        return True
+    except PlaywrightTimeoutError:
+        print(f"[{steamid}] Playwright: Модальное окно не закрылось за {timeout}мс.")
+        return False
+
+def _is_redeem_points_response(response) -> bool:
+    """Ответ на запрос выкупа предмета за очки."""
+    return "ILoyaltyRewardsService/RedeemPoints/v1" in response.url and response.request.method == "POST"
+
+def _is_free_license_response(response) -> bool:
+    """Ответ на запрос добавления бесплатной лицензии."""
+    return "addfreelicense" in response.url.lower()
+
 async def _click_element(page: Page, selector: str, steamid: str, label: str) -> bool:
     """Универсальный клик по элементу."""
     try:
@@ -164,21 +222,20 @@ async def _click_element(page: Page, selector: str, steamid: str, label: str) ->
         if btn and await btn.is_visible():
             print(f"[{steamid}] ✅ Найдена {label}. Выполняю клик.")
             await btn.click()
-            await asyncio.sleep(0.2)
             return True
         return False
     except Exception as e:
         print(f"[{steamid}] ❌ Ошибка при клике на {label}: {e}")
         return False
 
-async def _wait_and_click(page: Page, selector: str, steamid: str, label: str, timeout: int = 2000) -> bool:
+async def _wait_and_click(page: Page, selector: str, steamid: str, label: str, timeout: int | None = None) -> bool:
     """Ожидание элемента и последующий клик."""
+    timeout = timeout or _ui_timeout()
     try:
-        btn = await page.wait_for_selector(selector, timeout=timeout)
+        btn = await _wait_for_ui(page, selector, timeout=timeout)
         if btn:
             print(f"[{steamid}] ✅ {label} появилась. Кликаю.")
             await btn.click()
-            await asyncio.sleep(0.2)
             return True
     except PlaywrightTimeoutError:
         print(f"[{steamid}] ⚠️ {label} не появилась за {timeout}мс.")
@@ -186,8 +243,11 @@ async def _wait_and_click(page: Page, selector: str, steamid: str, label: str, t
         print(f"[{steamid}] ❌ Ошибка ожидания {label}: {e}")
     return False
 
-async def _attempt_to_close_any_modal(page: Page, steamid: str):
-    """Попытка закрыть любое открытое модальное окно или оверлей."""
+async def _attempt_to_close_any_modal(page: Page, steamid: str, modal_selector: str | None = None):
+    """
+    Попытка закрыть любое открытое модальное окно или оверлей.
+    Если передан modal_selector, после клика дожидается закрытия этого окна.
+    """
     close_selectors = [
         'button._3Ju8vy_foEPg9ILmy2-htb._1hcJa9ylImmFKuHsfilos.Focusable:has-text("Позже")',
         'button._3Ju8vy_foEPg9ILmy2-htb._1hcJa9ylImmFKuHsfilos.Focusable:has-text("Later")',
@@ -199,20 +259,47 @@ async def _attempt_to_close_any_modal(page: Page, steamid: str):
 
     for selector in close_selectors:
         if await _click_element(page, selector, steamid, f"кнопка закрытия ({selector[:20]}...)"):
+            if modal_selector:
+                await _wait_for_modal_closed(page, modal_selector, steamid)
             return True
     print(f"[{steamid}] Playwright: Кнопка закрытия/отмены не найдена.")
     return False
 
-async def _handle_success_modal(page: Page, steamid: str) -> bool:
-    """Ищет и закрывает модальное окно после успешного добавления игры."""
+async def _handle_success_modal(page: Page, steamid: str, license_response: asyncio.Future | None = None) -> bool:
+    """
+    Ищет и закрывает модальное окно после успешного добавления игры.
+    Ждет в пределах UI_TIMEOUT_MS то, что наступит раньше: само окно или ответ на запрос добавления
+    лицензии (license_response). После успешного ответа окно либо появляется сразу, либо не появится
+    вовсе, поэтому дальше ждем лишь UI_SETTLE_TIMEOUT_MS. Ответ с ошибкой считается неудачей.
+    """
     modal_selector = 'div.newmodal_content_border'
     ok_button_selector = 'div.newmodal_buttons span:has-text("OK"), div.newmodal_buttons span:has-text("ОК")'
+    modal_task = asyncio.ensure_future(page.wait_for_selector(modal_selector, timeout=UI_TIMEOUT_MS))
+    waiters = {modal_task, license_response} if license_response else {modal_task}
     try:
-        if await page.wait_for_selector(modal_selector, timeout=2000):
-            print(f"[{steamid}] ✅ Найдено модальное окно успеха. Пытаюсь закрыть его...")
-            return await _wait_and_click(page, ok_button_selector, steamid, "кнопка OK")
-    except:
+        done, _ = await asyncio.wait(waiters, timeout=UI_TIMEOUT_MS / 1000, return_when=asyncio.FIRST_COMPLETED)
+        if modal_task in done and not modal_task.exception():
+            modal = modal_task.result()
+        elif license_response in done and not license_response.exception():
+            response = license_response.result()
+            print(f"[{steamid}] Playwright: Запрос добавления лицензии завершен со статусом {response.status}.")
+            if not response.ok:
+                print(f"[{steamid}] ❌ Steam отклонил добавление лицензии (статус {response.status}).")
+                return False
+            modal = await page.wait_for_selector(modal_selector, timeout=UI_SETTLE_TIMEOUT_MS)
+        else:
+            print(f"[{steamid}] Playwright: Ни окно успеха, ни ответ на добавление лицензии не появились за {UI_TIMEOUT_MS}мс.")
+            return False
+
+        print(f"[{steamid}] ✅ Найдено модальное окно успеха. Пытаюсь закрыть его...")
+        if await _wait_and_click(page, ok_button_selector, steamid, "кнопка OK",
+                                timeout=UI_SETTLE_TIMEOUT_MS):
+            return await _wait_for_modal_closed(page, modal_selector, steamid)
+    except PlaywrightTimeoutError:
         print(f"[{steamid}] Playwright: Модальное окно успеха не появилось в ожидаемое время.")
+    finally:
+        if not modal_task.done():
+            modal_task.cancel()
     return False
 
 async def _check_and_click_add_button(page: Page, steamid: str) -> str | None:
@@ -311,9 +398,15 @@ async def collect_points_items(session: aiohttp.ClientSession, steamid: str, coo
             await page.route("**/api.steampowered.com/**", route_handler)
 
             await page.wait_for_selector('div.skI5tVFxF4zkY8z56LALc', timeout=30000)
-            await asyncio.sleep(2)
+            try:
+                await page.wait_for_selector('div.skI5tVFxF4zkY8z56LALc div.BqFe2n5bs-NKOIO-N-o-P:not(:empty)',
+                                             timeout=POINTS_SHOP_UI_TIMEOUT_MS)
+            except PlaywrightTimeoutError:
+                print(
+                    f"[{steamid}] Playwright: Цены предметов не отрисовались за {POINTS_SHOP_UI_TIMEOUT_MS}мс. Продолжаю.")
 
             item_elements = await page.query_selector_all('div.skI5tVFxF4zkY8z56LALc')
+            modal_container_selector = 'dialog._32QRvPPBL733SpNR9x0Gp3'
             print(f"[{steamid}] Playwright: Найдено {len(item_elements)} потенциальных элементов предметов.")
 
             for i, item_el in enumerate(item_elements):
@@ -340,15 +433,15 @@ async def collect_points_items(session: aiohttp.ClientSession, steamid: str, coo
                         await item_el.click()
                         print(f"[{steamid}] Playwright: Кликнул по элементу предмета.")
 
-                        modal_container_selector = 'dialog._32QRvPPBL733SpNR9x0Gp3'
                         try:
-                            modal_container = await page.wait_for_selector(modal_container_selector, timeout=10000)
+                            modal_container = await _wait_for_ui(page, modal_container_selector,
+                                                                 timeout=POINTS_SHOP_UI_TIMEOUT_MS)
                             print(
                                 f"[{steamid}] Playwright: Главный контейнер модального окна появился (селектор: '{modal_container_selector}').")
 
                             modal_overlay_content_selector = 'div.ModalOverlayContent.active'
-                            purchase_modal_content = await modal_container.wait_for_selector(
-                                modal_overlay_content_selector, timeout=5000)
+                            purchase_modal_content = await _wait_for_ui(modal_container, modal_overlay_content_selector,
+                                                                        timeout=POINTS_SHOP_UI_TIMEOUT_MS)
                             print(
                                 f"[{steamid}] Playwright: Активное содержимое модального окна появилось (селектор: '{modal_overlay_content_selector}').")
 
@@ -367,35 +460,43 @@ async def collect_points_items(session: aiohttp.ClientSession, steamid: str, coo
                             if free_purchase_button and await free_purchase_button.is_visible():
                                 print(
                                     f"[{steamid}] Playwright: Найдена кнопка 'Бесплатно' в модальном окне. Кликаю...")
-                                await free_purchase_button.click()
-                                await asyncio.sleep(0.5)
+                                try:
+                                    async with page.expect_response(_is_redeem_points_response,
+                                                                    timeout=NETWORK_TIMEOUT_MS) as redeem_info:
+                                        await free_purchase_button.click()
+                                    redeem_response = await redeem_info.value
+                                    print(
+                                        f"[{steamid}] Playwright: RedeemPoints ответил статусом {redeem_response.status}.")
+                                except PlaywrightTimeoutError:
+                                    print(
+                                        f"[{steamid}] Playwright: Ответ RedeemPoints не получен за {NETWORK_TIMEOUT_MS}мс.")
 
                                 try:
                                     later_button_selector = 'button._3Ju8vy_foEPg9ILmy2-htb._1hcJa9ylImmFKuHsfilos.Focusable:has-text("Позже"), button._3Ju8vy_foEPg9ILmy2-htb._1hcJa9ylImmFKuHsfilos.Focusable:has-text("Later")'
-                                    later_button = await page.wait_for_selector(later_button_selector, timeout=5000)
+                                    later_button = await _wait_for_ui(page, later_button_selector)
                                     if later_button and await later_button.is_visible():
                                         print(f"[{steamid}] Playwright: Найдена кнопка 'Позже'. Кликаю.")
                                         await later_button.click()
+                                        await _wait_for_modal_closed(page, modal_container_selector, steamid)
                                         print(
                                             f"[{steamid}] Playwright: ✅ Предмет #{i + 1} успешно куплен и модальное окно закрыто.")
-                                        await asyncio.sleep(0.2)
                                     else:
                                         print(
                                             f"[{steamid}] Playwright: Кнопка 'Позже' не найдена или невидима после покупки. Попытка закрыть модальное окно.")
-                                        await _attempt_to_close_any_modal(page, steamid)
+                                        await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
                                 except PlaywrightTimeoutError:
                                     print(
                                         f"[{steamid}] Playwright: Таймаут ожидания кнопки 'Позже' после покупки. Попытка закрыть модальное окно.")
-                                    await _attempt_to_close_any_modal(page, steamid)
+                                    await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
                                 except Exception as e:
                                     print(
                                         f"[{steamid}] Playwright: Ошибка при обработке кнопки 'Позже' после покупки: {e}. Попытка закрыть модальное окно.")
-                                    await _attempt_to_close_any_modal(page, steamid)
+                                    await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
 
                             elif equip_now_button and await equip_now_button.is_visible():
                                 print(
                                     f"[{steamid}] Playwright: Предмет #{i + 1} уже куплен (обнаружена кнопка 'Использовать сейчас'). Попытка закрыть модальное окно.")
-                                await _attempt_to_close_any_modal(page, steamid)
+                                await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
                                 print(
                                     f"[{steamid}] Playwright: ✅ Предмет #{i + 1} был уже куплен. Модальное окно закрыто.")
 
@@ -403,7 +504,7 @@ async def collect_points_items(session: aiohttp.ClientSession, steamid: str, coo
                                 print(
                                     f"[{steamid}] Playwright: Предмет #{i + 1} уже куплен (обнаружена кнопка 'Позже'). Попытка закрыть модальное окно.")
                                 await later_button_in_modal.click()
-                                await asyncio.sleep(0.2)
+                                await _wait_for_modal_closed(page, modal_container_selector, steamid)
                                 print(
                                     f"[{steamid}] Playwright: ✅ Предмет #{i + 1} был уже куплен. Модальное окно закрыто.")
 
@@ -417,27 +518,25 @@ async def collect_points_items(session: aiohttp.ClientSession, steamid: str, coo
                                 except Exception as debug_e:
                                     print(
                                         f"[{steamid}] Playwright: Отладка: Ошибка при получении innerHTML модального окна: {debug_e}")
-                                await _attempt_to_close_any_modal(page, steamid)
+                                await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
 
                         except PlaywrightTimeoutError:
                             print(
                                 f"[{steamid}] Playwright: Таймаут ожидания активного содержимого модального окна. Пропускаю этот предмет.")
-                            await _attempt_to_close_any_modal(page, steamid)
+                            await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
                         except Exception as modal_e:
                             print(
                                 f"[{steamid}] Playwright: Ошибка при работе с модальным окном (после клика по предмету): {modal_e}. Пропускаю этот предмет.")
-                            await _attempt_to_close_any_modal(page, steamid)
-
-                        await asyncio.sleep(0.5)
+                            await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
                     else:
                         print(
                             f"[{steamid}] Playwright: Предмет #{i + 1} не бесплатен (цена: '{price_text}'). Пропускаю.")
                 except PlaywrightTimeoutError:
                     print(f"[{steamid}] Playwright: Таймаут при обработке предмета #{i + 1}. Пропускаю.")
-                    await _attempt_to_close_any_modal(page, steamid)
+                    await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
                 except Exception as e:
                     print(f"[{steamid}] Playwright: Ошибка при обработке предмета #{i + 1}: {e}")
-                    await _attempt_to_close_any_modal(page, steamid)
+                    await _attempt_to_close_any_modal(page, steamid, modal_container_selector)
 
         except PlaywrightTimeoutError as e:
             print(f"[{steamid}] Playwright: Таймаут при загрузке страницы: {e}. Пропускаю.")
@@ -492,6 +591,7 @@ async def claim_free_game(steamid: str, cookies: dict, url: str):
     print(f"[{steamid}] Попытка получить бесплатную игру по ссылке: {url}")
 
     browser = None
+    license_response = None
     try:
         page, browser, context = await _setup_playwright_page(cookies, url, steamid)
 
@@ -501,9 +601,11 @@ async def claim_free_game(steamid: str, cookies: dict, url: str):
             return
 
         print(f"[{steamid}] Использую Playwright для имитации нажатия кнопки.")
+        license_response = asyncio.ensure_future(
+            page.wait_for_event("response", predicate=_is_free_license_response, timeout=UI_TIMEOUT_MS))
         action_type = await _check_and_click_add_button(page, steamid)
         if action_type == 'modal':
-            await _handle_success_modal(page, steamid)
+            await _handle_success_modal(page, steamid, license_response)
         elif action_type == 'redirect':
             print(f"[{steamid}] ✅ Игра успешно добавлена (переадресация на страницу подтверждения).")
 
@@ -512,6 +614,8 @@ async def claim_free_game(steamid: str, cookies: dict, url: str):
     except Exception as e:
         print(f"[{steamid}] Playwright: Общая ошибка при работе Playwright: {e}. Пропускаю.")
     finally:
+        if license_response and not license_response.done():
+            license_response.cancel()
         if browser:
             await browser.close()
 